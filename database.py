@@ -1,140 +1,421 @@
+import atexit
+import json
 import sqlite3
+from contextlib import contextmanager
 from datetime import datetime
 from typing import Dict, Any, List, Optional
 import threading
+import time
 
-db_lock = threading.Lock()
+# Column projections for list views - only what callers actually read
+BATCH_COLUMNS = "batch_id, status, total_documents, completed_documents, analysis_type, created_at, updated_at"
+DOCUMENT_LIST_COLUMNS = "document_id, batch_id, filename, status, quality_score, sharepoint_url, report_url, error_message, created_at"
+PENDING_DOCUMENT_COLUMNS = "document_id, batch_id, filename, local_path, analysis_type, user_email"
+
+# Status is stored as a small integer; callers only ever see the names
+STATUS = {'queued': 0, 'processing': 1, 'completed': 2, 'failed': 3}
+STATUS_NAME = {code: name for name, code in STATUS.items()}
+BATCH_STATUS = {'pending': 0, 'processing': 1, 'completed': 2}
+BATCH_STATUS_NAME = {code: name for name, code in BATCH_STATUS.items()}
+
+BATCHES_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS {table} (
+        batch_id TEXT PRIMARY KEY,
+        user_email TEXT NOT NULL,
+        analysis_type TEXT NOT NULL,
+        total_documents INTEGER DEFAULT 0,
+        completed_documents INTEGER DEFAULT 0,
+        status INTEGER DEFAULT 0,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+"""
+
+DOCUMENTS_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS {table} (
+        document_id TEXT PRIMARY KEY,
+        batch_id TEXT NOT NULL,
+        filename TEXT NOT NULL,
+        local_path TEXT NOT NULL,
+        analysis_type TEXT NOT NULL,
+        user_email TEXT NOT NULL,
+        status INTEGER DEFAULT 0,
+        quality_score REAL,
+        processing_started_at TIMESTAMP,
+        processing_completed_at TIMESTAMP,
+        sharepoint_url TEXT,
+        report_url TEXT,
+        error_message TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (batch_id) REFERENCES batches(batch_id)
+    )
+"""
+
+# Finished workflow results, keyed by input file hash, workflow mode and
+# workflow version (so a backend upgrade never serves stale results)
+WORKFLOW_CACHE_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS workflow_cache (
+        content_hash TEXT NOT NULL,
+        mode TEXT NOT NULL,
+        workflow_version TEXT NOT NULL,
+        quality_score REAL,
+        result_json TEXT NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (content_hash, mode, workflow_version)
+    ) WITHOUT ROWID
+"""
+
+def _status_case(mapping: Dict[str, int]) -> str:
+    """SQL CASE mapping legacy TEXT status values to their integer codes
+    
+    Unrecognised values are carried over unchanged rather than guessed at.
+    """
+    whens = ' '.join(f"WHEN '{name}' THEN {code}" for name, code in mapping.items())
+    return f"CASE status {whens} ELSE status END"
+
+def _document_row(row) -> Dict:
+    doc = dict(row)
+    if 'status' in doc:
+        doc['status'] = STATUS_NAME.get(doc['status'], doc['status'])
+    return doc
+
+def _batch_row(row) -> Dict:
+    batch = dict(row)
+    batch['status'] = BATCH_STATUS_NAME.get(batch['status'], batch['status'])
+    return batch
+
+# UPDATE/INSERT ... RETURNING needs SQLite 3.35+
+_HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+# PRAGMA optimize=0x10002 (analyze tables not yet queried) needs SQLite 3.46+
+_HAS_OPTIMIZE_ANALYSIS = sqlite3.sqlite_version_info >= (3, 46, 0)
+
+# Optional fields accepted by update_document_status, in bind order
+STATUS_UPDATE_FIELDS = ('quality_score', 'sharepoint_url', 'report_url', 'error_message')
+
+# One SQL string per (fields, terminal) shape, so sqlite3's per-connection
+# statement cache keeps hitting the same prepared statement
+_UPDATE_TEMPLATES: Dict[tuple, str] = {}
+
+def _build_status_update(fields: tuple, terminal: bool) -> str:
+    update_fields = ['status = ?']
+    if terminal:
+        update_fields.append('processing_completed_at = CURRENT_TIMESTAMP')
+    update_fields.extend(f'{field} = ?' for field in fields)
+    return f"UPDATE documents SET {', '.join(update_fields)} WHERE document_id = ?"
+
+def _status_update(document_id: str, status: str, fields: Dict) -> tuple:
+    """(query, values) for one document status update"""
+    present = tuple(field for field in STATUS_UPDATE_FIELDS if field in fields)
+    key = (present, status in ('completed', 'failed'))
+    query = _UPDATE_TEMPLATES.get(key)
+    if query is None:
+        query = _UPDATE_TEMPLATES.setdefault(key, _build_status_update(*key))
+    return query, [STATUS[status], *(fields[field] for field in present), document_id]
 
 class DocumentDatabase:
     """SQLite database for document processing"""
     
     def __init__(self, db_path: str = "document_processing.db"):
         self.db_path = db_path
+        
+        # One long-lived connection per thread; writers in this process are
+        # additionally serialized by a lock so they never race for SQLITE_BUSY
+        self._tls = threading.local()
+        self._write_lock = threading.Lock()
         self._init_database()
+        atexit.register(self.optimize)
+        
+        # (fetched_at_ms, stats) - reset by writers that change document status
+        self._stats_cache = (0.0, None)
     
     def _get_connection(self):
-        conn = sqlite3.connect(self.db_path, check_same_thread=False)
-        conn.row_factory = sqlite3.Row
+        """Return this thread's connection, opening it on first use"""
+        conn = getattr(self._tls, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, isolation_level=None, cached_statements=256)
+            conn.row_factory = sqlite3.Row
+            # journal_mode=WAL persists in the file, so it is only set in _init_database
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=5000")
+            conn.execute("PRAGMA cache_size=-20000")
+            conn.execute("PRAGMA temp_store=MEMORY")
+            conn.execute("PRAGMA foreign_keys=ON")
+            conn.execute("PRAGMA recursive_triggers=OFF")
+            conn.execute("PRAGMA mmap_size=268435456")
+            self._tls.conn = conn
         return conn
     
+    @contextmanager
+    def _writer(self):
+        """Yield this thread's connection while holding the write lock"""
+        with self._write_lock:
+            yield self._get_connection()
+    
+    @contextmanager
+    def _reader(self):
+        """Yield this thread's connection; reads take no Python lock"""
+        yield self._get_connection()
+    
+    @contextmanager
+    def _transaction(self):
+        """Write transaction on this thread's connection, taking the SQLite write lock up front"""
+        with self._writer() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+    
     def _init_database(self):
         """Initialize database schema"""
-        with db_lock:
-            conn = self._get_connection()
+        with self._writer() as conn:
             cursor = conn.cursor()
+            cursor.execute("PRAGMA journal_mode=WAL")
             
             # Batch table
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS batches (
-                    batch_id TEXT PRIMARY KEY,
-                    user_email TEXT NOT NULL,
-                    analysis_type TEXT NOT NULL,
-                    total_documents INTEGER DEFAULT 0,
-                    completed_documents INTEGER DEFAULT 0,
-                    status TEXT DEFAULT 'pending',
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
+            cursor.execute(BATCHES_SCHEMA.format(table='batches'))
             
             # Documents table
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS documents (
-                    document_id TEXT PRIMARY KEY,
-                    batch_id TEXT NOT NULL,
-                    filename TEXT NOT NULL,
-                    local_path TEXT NOT NULL,
-                    analysis_type TEXT NOT NULL,
-                    user_email TEXT NOT NULL,
-                    status TEXT DEFAULT 'queued',
-                    quality_score REAL,
-                    processing_started_at TIMESTAMP,
-                    processing_completed_at TIMESTAMP,
-                    sharepoint_url TEXT,
-                    report_url TEXT,
-                    error_message TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (batch_id) REFERENCES batches(batch_id)
-                )
-            """)
+            cursor.execute(DOCUMENTS_SCHEMA.format(table='documents'))
+            
+            # Workflow results cache - a cache from before workflow_version
+            # was part of the key cannot be trusted, so it is simply dropped
+            cache_columns = {row['name'] for row in cursor.execute("PRAGMA table_info(workflow_cache)")}
+            if cache_columns and 'workflow_version' not in cache_columns:
+                cursor.execute("DROP TABLE workflow_cache")
+            cursor.execute(WORKFLOW_CACHE_SCHEMA)
+            
+            # Databases created before status became INTEGER are rebuilt once
+            self._migrate_status_columns(conn)
             
-            # Indexes
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_status ON documents(status)")
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_batch ON documents(batch_id)")
+            # Indexes - composite so filtered queries come back already ordered
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_created ON documents(created_at)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_batch_created ON documents(batch_id, created_at)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_status_created ON documents(status, created_at)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_user_created ON batches(user_email, created_at DESC)")
+            
+            self._create_triggers(conn)
+            
+            # Superseded by the composite indexes above
+            cursor.execute("DROP INDEX IF EXISTS idx_status")
+            cursor.execute("DROP INDEX IF EXISTS idx_batch")
+            
+            self._refresh_planner_stats(cursor)
             
             conn.commit()
-            conn.close()
+    
+    def _refresh_planner_stats(self, cursor):
+        """ANALYZE when planner statistics are missing or the documents table
+        has more than doubled since they were gathered"""
+        analyzed_rows = None
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'")
+        if cursor.fetchone() is not None:
+            cursor.execute("SELECT stat FROM sqlite_stat1 WHERE tbl = 'documents' LIMIT 1")
+            row = cursor.fetchone()
+            analyzed_rows = int(row['stat'].split()[0]) if row else 0
+        
+        # max(rowid) is a single b-tree seek, unlike COUNT(*)
+        current_rows = cursor.execute("SELECT COALESCE(MAX(rowid), 0) FROM documents").fetchone()[0]
+        
+        if analyzed_rows is None or current_rows > 2 * analyzed_rows:
+            cursor.execute("ANALYZE")
+        elif _HAS_OPTIMIZE_ANALYSIS:
+            # 0x10002: check every table, even ones this connection has not queried
+            cursor.execute("PRAGMA optimize=0x10002")
+    
+    def optimize(self):
+        """Refresh planner statistics that have gone stale (cheap when nothing changed)"""
+        try:
+            with self._writer() as conn:
+                conn.execute("PRAGMA optimize")
+        except Exception as e:
+            print(f"Error optimizing database: {e}")
+    
+    def _create_triggers(self, conn):
+        """(Re)create triggers so existing databases pick up the current definitions"""
+        terminal = f"({STATUS['completed']}, {STATUS['failed']})"
+        triggers = {
+            # Keep batches.completed_documents in step with document status,
+            # in the same transaction as the document update
+            'trg_doc_complete': f"""
+                CREATE TRIGGER trg_doc_complete
+                AFTER UPDATE OF status ON documents
+                WHEN NEW.status IN {terminal} AND OLD.status NOT IN {terminal}
+                BEGIN
+                    UPDATE batches
+                    SET completed_documents = completed_documents + 1,
+                        status = CASE 
+                            WHEN completed_documents + 1 >= total_documents THEN {BATCH_STATUS['completed']}
+                            ELSE {BATCH_STATUS['processing']}
+                        END
+                    WHERE batch_id = NEW.batch_id;
+                END
+            """,
+            'trg_doc_reopen': f"""
+                CREATE TRIGGER trg_doc_reopen
+                AFTER UPDATE OF status ON documents
+                WHEN OLD.status IN {terminal} AND NEW.status NOT IN {terminal}
+                BEGIN
+                    UPDATE batches
+                    SET completed_documents = completed_documents - 1,
+                        status = {BATCH_STATUS['processing']}
+                    WHERE batch_id = NEW.batch_id;
+                END
+            """,
+            # updated_at only moves when user-visible state actually changes
+            'trg_doc_touch': """
+                CREATE TRIGGER trg_doc_touch
+                AFTER UPDATE ON documents
+                WHEN OLD.status IS NOT NEW.status
+                  OR OLD.quality_score IS NOT NEW.quality_score
+                  OR OLD.sharepoint_url IS NOT NEW.sharepoint_url
+                  OR OLD.report_url IS NOT NEW.report_url
+                  OR OLD.error_message IS NOT NEW.error_message
+                BEGIN
+                    UPDATE documents SET updated_at = CURRENT_TIMESTAMP WHERE document_id = NEW.document_id;
+                END
+            """,
+            'trg_batch_touch': """
+                CREATE TRIGGER trg_batch_touch
+                AFTER UPDATE ON batches
+                WHEN OLD.status IS NOT NEW.status
+                  OR OLD.completed_documents IS NOT NEW.completed_documents
+                  OR OLD.total_documents IS NOT NEW.total_documents
+                BEGIN
+                    UPDATE batches SET updated_at = CURRENT_TIMESTAMP WHERE batch_id = NEW.batch_id;
+                END
+            """,
+        }
+        
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for name, sql in triggers.items():
+                conn.execute(f"DROP TRIGGER IF EXISTS {name}")
+                conn.execute(sql)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    
+    def _migrate_status_columns(self, conn):
+        """Rebuild tables whose status column is still TEXT with integer status codes"""
+        if not self._status_is_text(conn):
+            return
+        
+        # Table rebuild per https://www.sqlite.org/lang_altertable.html#otheralter
+        conn.execute("PRAGMA foreign_keys=OFF")
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Another process may have migrated while we waited for the lock
+                if not self._status_is_text(conn):
+                    conn.rollback()
+                    return
+                
+                conn.execute("DROP TRIGGER IF EXISTS trg_doc_complete")
+                conn.execute("DROP TRIGGER IF EXISTS trg_doc_reopen")
+                
+                conn.execute(BATCHES_SCHEMA.format(table='batches_new'))
+                conn.execute(f"""
+                    INSERT INTO batches_new
+                    SELECT batch_id, user_email, analysis_type, total_documents, completed_documents,
+                           {_status_case(BATCH_STATUS)}, created_at, updated_at
+                    FROM batches
+                """)
+                conn.execute(DOCUMENTS_SCHEMA.format(table='documents_new'))
+                conn.execute(f"""
+                    INSERT INTO documents_new
+                    SELECT document_id, batch_id, filename, local_path, analysis_type, user_email,
+                           {_status_case(STATUS)}, quality_score, processing_started_at,
+                           processing_completed_at, sharepoint_url, report_url, error_message,
+                           created_at, updated_at
+                    FROM documents
+                """)
+                
+                conn.execute("DROP TABLE documents")
+                conn.execute("DROP TABLE batches")
+                conn.execute("ALTER TABLE batches_new RENAME TO batches")
+                conn.execute("ALTER TABLE documents_new RENAME TO documents")
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        finally:
+            conn.execute("PRAGMA foreign_keys=ON")
+    
+    @staticmethod
+    def _status_is_text(conn) -> bool:
+        columns = {row['name']: row['type'] for row in conn.execute("PRAGMA table_info(documents)")}
+        return columns.get('status', '').upper() == 'TEXT'
     
     # ========================================
     # BATCH OPERATIONS
     # ========================================
     
     def create_batch(self, batch_id: str, user_email: str, analysis_type: str, total_docs: int) -> bool:
-        with db_lock:
-            try:
-                conn = self._get_connection()
+        try:
+            with self._transaction() as conn:
                 cursor = conn.cursor()
                 cursor.execute("""
                     INSERT INTO batches (batch_id, user_email, analysis_type, total_documents)
                     VALUES (?, ?, ?, ?)
                 """, (batch_id, user_email, analysis_type, total_docs))
-                conn.commit()
-                conn.close()
-                return True
-            except Exception as e:
-                print(f"Error creating batch: {e}")
-                return False
+            return True
+        except Exception as e:
+            print(f"Error creating batch: {e}")
+            return False
     
     def get_batch(self, batch_id: str) -> Optional[Dict]:
-        with db_lock:
-            conn = self._get_connection()
+        with self._reader() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT * FROM batches WHERE batch_id = ?", (batch_id,))
+            cursor.execute(f"SELECT user_email, {BATCH_COLUMNS} FROM batches WHERE batch_id = ?", (batch_id,))
             row = cursor.fetchone()
-            conn.close()
-            return dict(row) if row else None
+            return _batch_row(row) if row else None
     
     def update_batch_progress(self, batch_id: str):
-        with db_lock:
-            conn = self._get_connection()
+        """Recount batch progress from its documents (the status triggers keep it current)"""
+        with self._transaction() as conn:
             cursor = conn.cursor()
             
+            # SET expressions see the old row, so the count is computed once
+            # in a CTE and used for both columns
             cursor.execute("""
-                SELECT COUNT(*) as completed 
-                FROM documents 
-                WHERE batch_id = ? AND status IN ('completed', 'failed')
-            """, (batch_id,))
-            completed = cursor.fetchone()['completed']
-            
-            cursor.execute("""
+                WITH progress AS (
+                    SELECT COUNT(*) as completed 
+                    FROM documents 
+                    WHERE batch_id = ? AND status IN (?, ?)
+                )
                 UPDATE batches 
-                SET completed_documents = ?,
+                SET completed_documents = (SELECT completed FROM progress),
                     status = CASE 
-                        WHEN ? >= total_documents THEN 'completed'
-                        ELSE 'processing'
-                    END,
-                    updated_at = CURRENT_TIMESTAMP
+                        WHEN (SELECT completed FROM progress) >= total_documents THEN ?
+                        ELSE ?
+                    END
                 WHERE batch_id = ?
-            """, (completed, completed, batch_id))
-            
-            conn.commit()
-            conn.close()
+            """, (
+                batch_id, STATUS['completed'], STATUS['failed'],
+                BATCH_STATUS['completed'], BATCH_STATUS['processing'],
+                batch_id
+            ))
     
     # ========================================
     # DOCUMENT OPERATIONS
     # ========================================
     
-    def add_document(self, document_data: Dict[str, Any]) -> bool:
-        with db_lock:
-            try:
-                conn = self._get_connection()
+    def add_document(self, document_data: Dict[str, Any]) -> Optional[Dict]:
+        """Insert a document; returns its document_id and created_at, or None on error"""
+        try:
+            with self._transaction() as conn:
                 cursor = conn.cursor()
-                cursor.execute("""
+                cursor.execute(f"""
                     INSERT INTO documents 
                     (document_id, batch_id, filename, local_path, analysis_type, user_email)
                     VALUES (?, ?, ?, ?, ?, ?)
+                    {'RETURNING document_id, created_at' if _HAS_RETURNING else ''}
                 """, (
                     document_data['document_id'],
                     document_data['batch_id'],
@@ -143,126 +424,252 @@ class DocumentDatabase:
                     document_data['analysis_type'],
                     document_data['user_email']
                 ))
-                conn.commit()
-                conn.close()
-                return True
-            except Exception as e:
-                print(f"Error adding document: {e}")
-                return False
+                if not _HAS_RETURNING:
+                    cursor.execute(
+                        "SELECT document_id, created_at FROM documents WHERE document_id = ?",
+                        (document_data['document_id'],)
+                    )
+                row = cursor.fetchall()[0]
+            self._invalidate_stats()
+            return dict(row)
+        except Exception as e:
+            print(f"Error adding document: {e}")
+            return None
+    
+    def add_documents_bulk(self, documents: List[Dict[str, Any]]) -> bool:
+        """Insert many documents in a single transaction"""
+        try:
+            with self._transaction() as conn:
+                self._insert_documents(conn.cursor(), documents)
+            self._invalidate_stats()
+            return True
+        except Exception as e:
+            print(f"Error adding documents: {e}")
+            return False
+    
+    def create_batch_with_documents(self, batch_id: str, user_email: str, analysis_type: str,
+                                    documents: List[Dict[str, Any]]) -> bool:
+        """Create a batch and all of its documents atomically"""
+        try:
+            with self._transaction() as conn:
+                cursor = conn.cursor()
+                cursor.execute("""
+                    INSERT INTO batches (batch_id, user_email, analysis_type, total_documents)
+                    VALUES (?, ?, ?, ?)
+                """, (batch_id, user_email, analysis_type, len(documents)))
+                self._insert_documents(cursor, documents)
+            self._invalidate_stats()
+            return True
+        except Exception as e:
+            print(f"Error creating batch: {e}")
+            return False
+    
+    def _insert_documents(self, cursor, documents: List[Dict[str, Any]]):
+        cursor.executemany("""
+            INSERT INTO documents 
+            (document_id, batch_id, filename, local_path, analysis_type, user_email)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, [
+            (
+                d['document_id'],
+                d['batch_id'],
+                d['filename'],
+                d['local_path'],
+                d['analysis_type'],
+                d['user_email']
+            )
+            for d in documents
+        ])
     
     def get_pending_documents(self, limit: int = 2) -> List[Dict]:
         """Get next pending documents (FIFO) - limited by max_workers"""
-        with db_lock:
-            conn = self._get_connection()
+        with self._reader() as conn:
             cursor = conn.cursor()
-            cursor.execute("""
-                SELECT * FROM documents 
-                WHERE status = 'queued'
+            cursor.execute(f"""
+                SELECT {PENDING_DOCUMENT_COLUMNS} FROM documents 
+                WHERE status = ?
                 ORDER BY created_at ASC
                 LIMIT ?
-            """, (limit,))
+            """, (STATUS['queued'], limit))
             rows = cursor.fetchall()
-            conn.close()
             return [dict(row) for row in rows]
     
-    def mark_document_processing(self, document_id: str) -> bool:
-        """Mark document as being processed"""
-        with db_lock:
-            try:
-                conn = self._get_connection()
+    def claim_pending_documents(self, limit: int = 2) -> List[Dict]:
+        """Atomically move the next queued documents (FIFO) to processing and return them"""
+        try:
+            with self._transaction() as conn:
                 cursor = conn.cursor()
-                cursor.execute("""
+                if _HAS_RETURNING:
+                    cursor.execute("""
+                        UPDATE documents
+                        SET status = ?,
+                            processing_started_at = CURRENT_TIMESTAMP
+                        WHERE document_id IN (
+                            SELECT document_id FROM documents
+                            WHERE status = ?
+                            ORDER BY created_at ASC
+                            LIMIT ?
+                        )
+                        RETURNING *
+                    """, (STATUS['processing'], STATUS['queued'], limit))
+                    rows = cursor.fetchall()
+                else:
+                    # BEGIN IMMEDIATE already holds the write lock, so no other
+                    # writer can claim these rows between the SELECT and UPDATE
+                    cursor.execute("""
+                        SELECT document_id FROM documents
+                        WHERE status = ?
+                        ORDER BY created_at ASC
+                        LIMIT ?
+                    """, (STATUS['queued'], limit))
+                    ids = [row['document_id'] for row in cursor.fetchall()]
+                    placeholders = ', '.join('?' * len(ids))
+                    cursor.execute(f"""
+                        UPDATE documents
+                        SET status = ?,
+                            processing_started_at = CURRENT_TIMESTAMP
+                        WHERE document_id IN ({placeholders})
+                    """, (STATUS['processing'], *ids))
+                    cursor.execute(f"SELECT * FROM documents WHERE document_id IN ({placeholders})", ids)
+                    rows = cursor.fetchall()
+            if rows:
+                self._invalidate_stats()
+            # RETURNING does not guarantee order
+            return sorted((_document_row(row) for row in rows), key=lambda doc: doc['created_at'])
+        except Exception as e:
+            print(f"Error claiming documents: {e}")
+            return []
+    
+    def mark_document_processing(self, document_id: str) -> Optional[Dict]:
+        """Mark document as being processed; returns the updated row, or None"""
+        try:
+            with self._transaction() as conn:
+                cursor = conn.cursor()
+                cursor.execute(f"""
                     UPDATE documents 
-                    SET status = 'processing',
-                        processing_started_at = CURRENT_TIMESTAMP,
-                        updated_at = CURRENT_TIMESTAMP
+                    SET status = ?,
+                        processing_started_at = CURRENT_TIMESTAMP
                     WHERE document_id = ?
-                """, (document_id,))
-                conn.commit()
-                conn.close()
-                return True
-            except Exception as e:
-                print(f"Error marking document: {e}")
-                return False
+                    {'RETURNING *' if _HAS_RETURNING else ''}
+                """, (STATUS['processing'], document_id))
+                if not _HAS_RETURNING:
+                    cursor.execute("SELECT * FROM documents WHERE document_id = ?", (document_id,))
+                rows = cursor.fetchall()
+            self._invalidate_stats()
+            return _document_row(rows[0]) if rows else None
+        except Exception as e:
+            print(f"Error marking document: {e}")
+            return None
     
     def update_document_status(self, document_id: str, status: str, **kwargs):
-        with db_lock:
-            conn = self._get_connection()
-            cursor = conn.cursor()
-            
-            update_fields = ['status = ?', 'updated_at = CURRENT_TIMESTAMP']
-            values = [status]
-            
-            if status in ('completed', 'failed'):
-                update_fields.append('processing_completed_at = CURRENT_TIMESTAMP')
-            
-            if 'quality_score' in kwargs:
-                update_fields.append('quality_score = ?')
-                values.append(kwargs['quality_score'])
-            if 'sharepoint_url' in kwargs:
-                update_fields.append('sharepoint_url = ?')
-                values.append(kwargs['sharepoint_url'])
-            if 'report_url' in kwargs:
-                update_fields.append('report_url = ?')
-                values.append(kwargs['report_url'])
-            if 'error_message' in kwargs:
-                update_fields.append('error_message = ?')
-                values.append(kwargs['error_message'])
-            
-            values.append(document_id)
-            
-            query = f"UPDATE documents SET {', '.join(update_fields)} WHERE document_id = ?"
-            cursor.execute(query, values)
-            conn.commit()
-            conn.close()
+        query, values = _status_update(document_id, status, kwargs)
+        with self._transaction() as conn:
+            conn.execute(query, values)
+        self._invalidate_stats()
+    
+    def bulk_update_document_status(self, rows: List[Dict]):
+        """Apply many status updates in one transaction
+        
+        Each row holds document_id, status and any of STATUS_UPDATE_FIELDS;
+        rows sharing a shape go through one executemany.
+        """
+        grouped: Dict[str, List[list]] = {}
+        for row in rows:
+            query, values = _status_update(row['document_id'], row['status'], row)
+            grouped.setdefault(query, []).append(values)
+        
+        if not grouped:
+            return
+        
+        with self._transaction() as conn:
+            for query, values in grouped.items():
+                conn.executemany(query, values)
+        self._invalidate_stats()
     
     def get_document(self, document_id: str) -> Optional[Dict]:
-        with db_lock:
-            conn = self._get_connection()
+        with self._reader() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM documents WHERE document_id = ?", (document_id,))
             row = cursor.fetchone()
-            conn.close()
-            return dict(row) if row else None
+            return _document_row(row) if row else None
     
     def get_batch_documents(self, batch_id: str) -> List[Dict]:
-        with db_lock:
-            conn = self._get_connection()
+        with self._reader() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT * FROM documents WHERE batch_id = ? ORDER BY created_at", (batch_id,))
+            cursor.execute(f"SELECT {DOCUMENT_LIST_COLUMNS} FROM documents WHERE batch_id = ? ORDER BY created_at", (batch_id,))
             rows = cursor.fetchall()
-            conn.close()
-            return [dict(row) for row in rows]
+            return [_document_row(row) for row in rows]
+    
+    def get_cached_workflow_result(self, content_hash: str, mode: str, workflow_version: str) -> Optional[Dict]:
+        """Workflow result previously stored for this input, mode and workflow version, if any"""
+        try:
+            with self._reader() as conn:
+                row = conn.execute(
+                    "SELECT result_json FROM workflow_cache WHERE content_hash = ? AND mode = ? AND workflow_version = ?",
+                    (content_hash, mode, workflow_version)
+                ).fetchone()
+                return json.loads(row['result_json']) if row else None
+        except Exception as e:
+            print(f"Error reading workflow cache: {e}")
+            return None
+    
+    def cache_workflow_result(self, content_hash: str, mode: str, workflow_version: str,
+                              quality_score: float, result: Dict) -> bool:
+        try:
+            result_json = json.dumps(result, default=str)
+            with self._transaction() as conn:
+                conn.execute("""
+                    INSERT OR REPLACE INTO workflow_cache (content_hash, mode, workflow_version, quality_score, result_json)
+                    VALUES (?, ?, ?, ?, ?)
+                """, (content_hash, mode, workflow_version, quality_score, result_json))
+            return True
+        except Exception as e:
+            print(f"Error caching workflow result: {e}")
+            return False
+    
+    def has_queued_documents(self) -> bool:
+        """Cheap check for any queued work - one seek into idx_status_created"""
+        with self._reader() as conn:
+            row = conn.execute(
+                "SELECT EXISTS (SELECT 1 FROM documents WHERE status = ?)", (STATUS['queued'],)
+            ).fetchone()
+            return bool(row[0])
     
-    def get_processing_stats(self) -> Dict[str, int]:
-        with db_lock:
-            conn = self._get_connection()
+    def data_version(self) -> int:
+        """Counter that changes whenever another connection commits to the database"""
+        with self._reader() as conn:
+            return conn.execute("PRAGMA data_version").fetchone()[0]
+    
+    def get_processing_stats(self, ttl_ms: int = 500) -> Dict[str, int]:
+        """Status counts, served from cache if younger than ttl_ms"""
+        fetched_at, stats = self._stats_cache
+        if stats is not None and time.monotonic() * 1000 - fetched_at < ttl_ms:
+            return stats
+        
+        stats = self._compute_stats()
+        self._stats_cache = (time.monotonic() * 1000, stats)
+        return stats
+    
+    def _invalidate_stats(self):
+        self._stats_cache = (0.0, None)
+    
+    def _compute_stats(self) -> Dict[str, int]:
+        with self._reader() as conn:
             cursor = conn.cursor()
+            cursor.execute("SELECT status, COUNT(*) as count FROM documents GROUP BY status")
+            counts = {row['status']: row['count'] for row in cursor.fetchall()}
             
-            stats = {}
-            cursor.execute("SELECT COUNT(*) as count FROM documents WHERE status = 'queued'")
-            stats['queued'] = cursor.fetchone()['count']
-            
-            cursor.execute("SELECT COUNT(*) as count FROM documents WHERE status = 'processing'")
-            stats['processing'] = cursor.fetchone()['count']
-            
-            cursor.execute("SELECT COUNT(*) as count FROM documents WHERE status = 'completed'")
-            stats['completed'] = cursor.fetchone()['count']
-            
-            cursor.execute("SELECT COUNT(*) as count FROM documents WHERE status = 'failed'")
-            stats['failed'] = cursor.fetchone()['count']
-            
-            conn.close()
-            return stats
+            return {name: counts.get(code, 0) for name, code in STATUS.items()}
 
 
     def get_user_batches(self, user_email: str, limit: int = 10) -> List[Dict]:
         """Get recent batches for specific user"""
-        with db_lock:
-            conn = self._get_connection()
+        with self._reader() as conn:
             cursor = conn.cursor()
             cursor.execute("""
-            SELECT b.* FROM batches b
+            SELECT b.batch_id, b.status, b.total_documents, b.completed_documents,
+                   b.analysis_type, b.created_at, b.updated_at
+            FROM batches b
             JOIN documents d ON b.batch_id = d.batch_id
             WHERE b.user_email = ? 
             GROUP BY b.batch_id
@@ -270,5 +677,32 @@ class DocumentDatabase:
             LIMIT ?
             """, (user_email, limit))
             rows = cursor.fetchall()
-            conn.close()
-            return [dict(row) for row in rows]
+            return [_batch_row(row) for row in rows]
+    
+    def get_user_batches_with_documents(self, user_email: str, limit: int = 20) -> List[Dict]:
+        """Get recent batches for specific user, each with its documents under 'documents'"""
+        with self._reader() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"""
+            SELECT {BATCH_COLUMNS} FROM batches
+            WHERE user_email = ?
+            ORDER BY created_at DESC
+            LIMIT ?
+            """, (user_email, limit))
+            batches = cursor.fetchall()
+            if not batches:
+                return []
+            
+            batch_ids = [batch['batch_id'] for batch in batches]
+            placeholders = ', '.join('?' * len(batch_ids))
+            cursor.execute(f"""
+            SELECT {DOCUMENT_LIST_COLUMNS} FROM documents
+            WHERE batch_id IN ({placeholders})
+            ORDER BY batch_id, created_at
+            """, batch_ids)
+            documents = cursor.fetchall()
+        
+        by_batch = {}
+        for doc in documents:
+            by_batch.setdefault(doc['batch_id'], []).append(_document_row(doc))
+        return [{**_batch_row(batch), 'documents': by_batch.get(batch['batch_id'], [])} for batch in batches]
@@ -2,10 +2,16 @@ import streamlit as st
 import uuid
 from pathlib import Path
 import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 from database import DocumentDatabase
 
-# Initialize database
-db = DocumentDatabase()
+# One DocumentDatabase per Streamlit process, shared by all sessions
+@st.cache_resource
+def get_db() -> DocumentDatabase:
+    return DocumentDatabase()
+
+db = get_db()
 
 # Upload directory
 UPLOAD_DIR = "uploads"
@@ -22,9 +28,29 @@ def validate_and_format_email(email: str) -> str:
         return f"{username}@{domain}"
     return f"{email}@ubs.com"
 
+def save_uploaded_file(uploaded_file, batch_id: str, document_id: str) -> str:
+    """Stream one uploaded file to UPLOAD_DIR and return its path"""
+    file_path = os.path.join(UPLOAD_DIR, f"{batch_id}_{document_id}_{uploaded_file.name}")
+    uploaded_file.seek(0)
+    with open(file_path, "wb") as f:
+        shutil.copyfileobj(uploaded_file, f, length=65536)
+    return file_path
+
+# Read helpers are cached across reruns for about one watcher poll;
+# they are cleared on upload and on Refresh so new data shows at once
+@st.cache_data(ttl=2)
 def get_user_batches(user_email: str, limit: int = 10) -> list:
-    """Get recent batches for user"""
-    return db.get_user_batches(user_email, limit)
+    """Get recent batches for user, each with its documents"""
+    return db.get_user_batches_with_documents(user_email, limit)
+
+@st.cache_data(ttl=1)
+def get_queue_stats() -> dict:
+    """Get queue-wide document counts by status"""
+    return db.get_processing_stats()
+
+def clear_cached_reads():
+    get_user_batches.clear()
+    get_queue_stats.clear()
 
 def main():
     st.set_page_config(page_title="KAT Bulk Upload", page_icon="📤", layout="wide")
@@ -55,7 +81,7 @@ def main():
         
         st.markdown("---")
         st.header("📊 Queue Status")
-        stats = db.get_processing_stats()
+        stats = get_queue_stats()
         col1, col2, col3, col4 = st.columns(4)
         col1.metric("⏳ Queued", stats['queued'])
         col2.metric("🔄 Processing", stats['processing'])
@@ -63,6 +89,7 @@ def main():
         col4.metric("❌ Failed", stats['failed'])
         
         if st.button("🔄 Refresh"):
+            clear_cached_reads()
             st.rerun()
     
     # Require UBS email
@@ -95,34 +122,42 @@ def main():
         if uploaded_files and st.button("🚀 Upload & Queue", type="primary"):
             with st.spinner(f"📤 Uploading {len(uploaded_files)} files..."):
                 batch_id = f"ubs_{uuid.uuid4().hex[:12]}"
-                db.create_batch(batch_id, user_email, analysis_type, len(uploaded_files))
                 
-                success_count = 0
-                for uploaded_file in uploaded_files:
+                # Files are written in parallel; the document ID in each path keeps
+                # same-named files in one batch from landing on the same file
+                with ThreadPoolExecutor(max_workers=min(8, len(uploaded_files))) as executor:
+                    futures = []
+                    for uploaded_file in uploaded_files:
+                        document_id = f"doc_{uuid.uuid4().hex[:12]}"
+                        future = executor.submit(save_uploaded_file, uploaded_file, batch_id, document_id)
+                        futures.append((uploaded_file, document_id, future))
+                
+                documents = []
+                for uploaded_file, document_id, future in futures:
                     try:
-                        file_path = os.path.join(UPLOAD_DIR, f"{batch_id}_{uploaded_file.name}")
-                        with open(file_path, "wb") as f:
-                            f.write(uploaded_file.read())
+                        file_path = future.result()
                         
-                        document_id = f"doc_{uuid.uuid4().hex[:12]}"
-                        document_data = {
+                        documents.append({
                             'document_id': document_id,
                             'batch_id': batch_id,
                             'filename': uploaded_file.name,
                             'local_path': file_path,
                             'analysis_type': analysis_type,
                             'user_email': user_email
-                        }
-                        
-                        if db.add_document(document_data):
-                            success_count += 1
+                        })
                             
                     except Exception as e:
                         st.error(f"❌ {uploaded_file.name}: {e}")
                 
+                # Batch + documents become visible in one transaction
+                success_count = 0
+                if documents and db.create_batch_with_documents(batch_id, user_email, analysis_type, documents):
+                    success_count = len(documents)
+                
                 st.success(f"✅ **{success_count}/{len(uploaded_files)}** queued!")
                 st.info(f"📋 **Batch ID:** `{batch_id}`")
                 st.balloons()
+                clear_cached_reads()
                 st.rerun()
     
     with tab2:
@@ -151,8 +186,7 @@ def main():
                     st.markdown(f"**Updated:** {batch['updated_at']}")
                 
                 # Show documents in this batch
-                documents = db.get_batch_documents(batch['batch_id'])
-                for doc in documents:
+                for doc in batch['documents']:
                     status_emoji = {
                         'queued': '⏳ Queued',
                         'processing': '🔄 Processing', 
@@ -1,30 +1,61 @@
 import asyncio
+import atexit
+import hashlib
+import html
 import logging
+import queue
+import string
+import sys
 from datetime import datetime
 from pathlib import Path
 import os
 import tempfile
+import types
+import threading
 from concurrent.futures import ThreadPoolExecutor
-from typing import Dict, Any
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, Any, List
+
+try:
+    import uvloop  # Optional: faster event loop on Linux
+except ImportError:
+    uvloop = None
 
 from database import DocumentDatabase
 from msgraph_sharepoint_service import MSGraphSharePointService
 from backend_v4 import DocumentWorkflow  # Your existing backend
 
-# Setup logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('processor.log'),
-        logging.StreamHandler()
-    ]
-)
+# Setup logging - callers only enqueue records; a background listener
+# thread does the formatting and the file/console writes
+_log_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+_log_handlers = [logging.FileHandler('processor.log'), logging.StreamHandler()]
+for _handler in _log_handlers:
+    _handler.setFormatter(_log_formatter)
+
+_log_queue = queue.Queue(-1)
+_log_listener = QueueListener(_log_queue, *_log_handlers)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
+_root_logger = logging.getLogger()
+_root_logger.setLevel(logging.INFO)
+_root_logger.addHandler(QueueHandler(_log_queue))
 logger = logging.getLogger(__name__)
 
 # Configuration
 QUALITY_THRESHOLD = 7.0
 MAX_WORKERS = 2  # Process 2 documents at a time
+OPTIMIZE_EVERY = 1000  # Refresh SQLite planner stats after this many documents
+# Upload staging lives in RAM (tmpfs) where available, so writing the
+# report/content files before upload never touches the disk
+UPLOAD_STAGING_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+# Analysis type (as chosen in the upload form) -> workflow mode; read-only
+WORKFLOW_MODE_MAP = types.MappingProxyType({
+    'content_improvement': 'content_improvement',
+    'full_automation': 'full_automation',
+    'quality_check': 'content_improvement'
+})
 
 # Initialize services
 db = DocumentDatabase()
@@ -36,58 +67,180 @@ SHAREPOINT_CONFIG = {
     'tenant_id': os.getenv('SHAREPOINT_TENANT_ID')
 }
 
+# Failure report page, parsed once at import; only the per-document fields
+# are substituted per call (user-provided values are HTML-escaped).
+# Indentation and newlines are stripped up front so every uploaded report
+# carries only the markup itself. The skin stays inline on purpose: each
+# report must render on its own when opened from SharePoint, without
+# fetching a shared template file through an iframe or script
+FAILURE_HTML_TEMPLATE = string.Template(''.join(line.strip() for line in """
+<!DOCTYPE html>
+<html>
+<head>
+    <title>Processing Failed - $filename</title>
+    <style>
+        body { font-family: Arial, sans-serif; margin: 40px; background: #f5f5f5; }
+        .container { background: white; padding: 30px; border-radius: 10px; box-shadow: 0 2px 10px rgba(0,0,0,0.1); }
+        .header { background: linear-gradient(135deg, #ff4444 0%, #cc0000 100%); color: white; padding: 30px; border-radius: 5px; margin: -30px -30px 30px -30px; }
+        .score { font-size: 72px; font-weight: bold; color: #ff4444; text-align: center; margin: 30px 0; }
+        .threshold { font-size: 24px; color: #666; text-align: center; }
+        .details { background: #f9f9f9; padding: 20px; border-radius: 5px; margin: 20px 0; }
+        .recommendations { background: #fff3cd; padding: 20px; border-radius: 5px; border-left: 4px solid #ffc107; }
+    </style>
+</head>
+<body>
+    <div class="container">
+        <div class="header">
+            <h1>❌ Document Processing Failed</h1>
+            <p>Quality threshold not met</p>
+        </div>
+        
+        <div class="score">$quality_score/10</div>
+        <div class="threshold">Threshold Required: $threshold/10</div>
+        
+        <div class="details">
+            <h2>Document Details</h2>
+            <p><strong>Filename:</strong> $filename</p>
+            <p><strong>User:</strong> $user_email</p>
+            <p><strong>Analysis Type:</strong> $analysis_type</p>
+            <p><strong>Processed:</strong> $processed_at</p>
+            <p><strong>Status:</strong> <span style="color: #ff4444; font-weight: bold;">REJECTED</span></p>
+        </div>
+        
+        <div class="recommendations">
+            <h3>💡 Recommendations</h3>
+            <ul>
+                <li>Review document content quality and completeness</li>
+                <li>Check for clarity, structure, and formatting</li>
+                <li>Ensure all required sections are present</li>
+                <li>Verify technical accuracy and consistency</li>
+                <li>Resubmit after making improvements</li>
+            </ul>
+        </div>
+    </div>
+</body>
+</html>
+""".splitlines()))
+
+# One event loop per worker thread, reused for every document that thread
+# handles; all of them are closed at interpreter exit
+_thread_loop = threading.local()
+_thread_loops = []
+
+
+def _get_thread_loop() -> asyncio.AbstractEventLoop:
+    loop = getattr(_thread_loop, 'loop', None)
+    if loop is None:
+        loop = _thread_loop.loop = uvloop.new_event_loop() if uvloop else asyncio.new_event_loop()
+        _thread_loops.append(loop)
+    return loop
+
+
+def _close_thread_loops():
+    for loop in _thread_loops:
+        if not loop.is_closed():
+            loop.close()
+
+
+atexit.register(_close_thread_loops)
+
+
+def _hash_file(path: str, chunk_size: int = 1024 * 1024) -> str:
+    """sha256 of a file, read in chunks so large PDFs never sit in memory whole"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Part of every workflow cache key: a hash of the backend's source, so
+# results cached by an older backend are never served after an upgrade
+WORKFLOW_VERSION = _hash_file(sys.modules[DocumentWorkflow.__module__].__file__)[:16]
+
 
 class DocumentProcessor:
     """Background processor for documents"""
     
     def __init__(self):
-        self.sp_service = None
+        # One SharePoint client per uploading thread, always created and used
+        # on that thread, so no client's HTTP session is shared across threads
+        self._sp_local = threading.local()
         self.workflow = DocumentWorkflow()
+        self.processed_since_optimize = 0
+        
+        # Long-lived pool: worker threads (and their thread-local DB
+        # connections) survive across watcher cycles
+        self.executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="kat")
+        atexit.register(self.executor.shutdown)
     
-    def _init_sharepoint(self):
-        """Lazy initialize SharePoint (only when needed)"""
-        if self.sp_service is None:
-            self.sp_service = MSGraphSharePointService(SHAREPOINT_CONFIG)
+    def _init_sharepoint(self) -> MSGraphSharePointService:
+        """Lazy initialize the calling thread's SharePoint client (only when needed)"""
+        sp_service = getattr(self._sp_local, 'sp_service', None)
+        if sp_service is None:
+            sp_service = self._sp_local.sp_service = MSGraphSharePointService(SHAREPOINT_CONFIG)
+        return sp_service
     
     def run(self):
         """Main processing loop - run this via cron"""
-        logger.info("=" * 60)
         logger.info("🚀 Starting document processing cycle")
-        logger.info("=" * 60)
         
-        # Get pending documents
-        pending_docs = db.get_pending_documents(limit=MAX_WORKERS)
+        # Claim pending documents - one atomic queued -> processing update
+        pending_docs = db.claim_pending_documents(limit=MAX_WORKERS)
         
         if not pending_docs:
             logger.info("✅ No pending documents. Exiting.")
             return
         
-        logger.info(f"📋 Found {len(pending_docs)} pending documents")
+        logger.info(f"📋 Claimed {len(pending_docs)} pending documents")
         
         # Process documents in parallel (max 2 threads)
-        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-            futures = []
-            for doc in pending_docs:
-                # Mark as processing
-                db.mark_document_processing(doc['document_id'])
-                
-                # Submit to thread pool
-                future = executor.submit(self.process_document, doc)
-                futures.append(future)
-            
-            # Wait for all to complete
-            for future in futures:
-                try:
-                    future.result()
-                except Exception as e:
-                    logger.error(f"❌ Thread execution error: {e}")
+        futures = {self.executor.submit(self.process_document, doc): doc for doc in pending_docs}
+        
+        # Wait for all to complete; a claimed document always gets an outcome,
+        # even when its thread blew up, so none is left in 'processing'
+        status_updates = []
+        for future, doc in futures.items():
+            try:
+                status_updates.append(future.result())
+            except Exception as e:
+                logger.error(f"❌ Thread execution error: {e}")
+                status_updates.append({
+                    'document_id': doc['document_id'],
+                    'status': 'failed',
+                    'error_message': str(e)
+                })
+        
+        self._record_status_updates(status_updates)
+        
+        # Keep query plans in step with the growing documents table
+        self.processed_since_optimize += len(pending_docs)
+        if self.processed_since_optimize >= OPTIMIZE_EVERY:
+            db.optimize()
+            self.processed_since_optimize = 0
         
-        logger.info("=" * 60)
         logger.info("✅ Processing cycle complete")
-        logger.info("=" * 60)
     
-    def process_document(self, doc: Dict[str, Any]):
-        """Process a single document (runs in thread)"""
+    def _record_status_updates(self, status_updates: List[Dict[str, Any]]):
+        """Write the cycle's outcomes in one transaction, row by row if that fails"""
+        try:
+            db.bulk_update_document_status(status_updates)
+            return
+        except Exception as e:
+            logger.error(f"❌ Bulk status update failed, retrying per document: {e}")
+        
+        for update in status_updates:
+            try:
+                db.update_document_status(**update)
+            except Exception as e:
+                logger.error(f"❌ {update['document_id']}: Status update failed - {e}")
+    
+    def process_document(self, doc: Dict[str, Any]) -> Dict[str, Any]:
+        """Process a single document (runs in thread); returns its status update"""
+        return _get_thread_loop().run_until_complete(self._process_document_async(doc))
+    
+    async def _process_document_async(self, doc: Dict[str, Any]) -> Dict[str, Any]:
+        """Workflow and upload for one document, on one event loop"""
         document_id = doc['document_id']
         filename = doc['filename']
         
@@ -95,17 +248,16 @@ class DocumentProcessor:
             logger.info(f"📄 Processing: {filename} (ID: {document_id})")
             
             # Run document through workflow
-            result = asyncio.run(self._process_async(doc))
+            result = await self._process_async(doc)
             
             if not result['success']:
                 # Processing error
-                db.update_document_status(
-                    document_id,
-                    'failed',
-                    error_message=result.get('error', 'Unknown error')
-                )
                 logger.error(f"❌ {filename}: Processing failed - {result.get('error')}")
-                return
+                return {
+                    'document_id': document_id,
+                    'status': 'failed',
+                    'error_message': result.get('error', 'Unknown error')
+                }
             
             # Get quality score
             quality_score = result.get('quality_score', 0)
@@ -113,70 +265,72 @@ class DocumentProcessor:
             # Check threshold
             if quality_score >= QUALITY_THRESHOLD:
                 # APPROVED - Upload to SharePoint
-                self._init_sharepoint()
-                upload_result = self._upload_approved(doc, result)
-                
-                db.update_document_status(
-                    document_id,
-                    'completed',
-                    quality_score=quality_score,
-                    sharepoint_url=upload_result.get('content_url', ''),
-                    report_url=upload_result.get('html_url', '')
-                )
+                upload_result = await self._upload_approved(doc, result)
                 
                 logger.info(f"✅ {filename}: APPROVED (score: {quality_score:.1f}) - Uploaded to SharePoint")
+                return {
+                    'document_id': document_id,
+                    'status': 'completed',
+                    'quality_score': quality_score,
+                    'sharepoint_url': upload_result.get('content_url', ''),
+                    'report_url': upload_result.get('html_url', '')
+                }
             
             else:
                 # REJECTED - Generate failure report
-                self._init_sharepoint()
                 report_url = self._upload_failure_report(doc, result)
                 
-                db.update_document_status(
-                    document_id,
-                    'failed',
-                    quality_score=quality_score,
-                    report_url=report_url,
-                    error_message=f"Quality score {quality_score:.1f} below threshold {QUALITY_THRESHOLD}"
-                )
-                
                 logger.warning(f"⚠️ {filename}: REJECTED (score: {quality_score:.1f})")
-            
-            # Update batch progress
-            db.update_batch_progress(doc['batch_id'])
+                return {
+                    'document_id': document_id,
+                    'status': 'failed',
+                    'quality_score': quality_score,
+                    'report_url': report_url,
+                    'error_message': f"Quality score {quality_score:.1f} below threshold {QUALITY_THRESHOLD}"
+                }
             
         except Exception as e:
             logger.error(f"❌ {filename}: Unexpected error - {e}")
-            db.update_document_status(
-                document_id,
-                'failed',
-                error_message=str(e)
-            )
+            return {
+                'document_id': document_id,
+                'status': 'failed',
+                'error_message': str(e)
+            }
     
     async def _process_async(self, doc: Dict) -> Dict[str, Any]:
         """Run document through workflow"""
         try:
-            # Map analysis type to workflow mode
-            workflow_mode_map = {
-                'content_improvement': 'content_improvement',
-                'full_automation': 'full_automation',
-                'quality_check': 'content_improvement'
-            }
+            # Map analysis type to workflow mode - unknown types are a bug upstream
+            workflow_mode = WORKFLOW_MODE_MAP.get(doc['analysis_type'])
+            if workflow_mode is None:
+                return {
+                    'success': False,
+                    'error': f"Unknown analysis type: {doc['analysis_type']!r}"
+                }
             
-            workflow_mode = workflow_mode_map.get(doc['analysis_type'], 'content_improvement')
-            
-            initial_state = {
-                'pdf_path': doc['local_path'],
-                'workflow_mode': workflow_mode,
-                'messages': [],
-                'current_step': 'start'
-            }
-            
-            final_state = await self.workflow.run_workflow(initial_state)
+            # Same file, same mode -> reuse the earlier result
+            content_hash = await asyncio.to_thread(_hash_file, doc['local_path'])
+            cached = db.get_cached_workflow_result(content_hash, workflow_mode, WORKFLOW_VERSION)
+            if cached is not None:
+                logger.info(f"♻️ {doc['filename']}: reusing cached workflow result")
+                final_state = cached
+            else:
+                initial_state = {
+                    'pdf_path': doc['local_path'],
+                    'workflow_mode': workflow_mode,
+                    'messages': [],
+                    'current_step': 'start'
+                }
+                
+                final_state = await self.workflow.run_workflow(initial_state)
             
             # Extract quality score
             quality_scores = final_state.get('automation_analysis', {}).get('quality_scores', {})
             overall_score = quality_scores.get('overall_score', 0.0)
             
+            if cached is None:
+                db.cache_workflow_result(content_hash, workflow_mode, WORKFLOW_VERSION, overall_score, final_state)
+            
             return {
                 'success': True,
                 'quality_score': overall_score,
@@ -190,8 +344,12 @@ class DocumentProcessor:
                 'error': str(e)
             }
     
-    def _upload_approved(self, doc: Dict, result: Dict) -> Dict[str, str]:
-        """Upload approved document to SharePoint"""
+    def _upload_file(self, local_path: str, folder: str) -> Dict:
+        """Upload one file with the calling thread's own SharePoint client"""
+        return self._init_sharepoint().upload_file_to_folder(local_path, folder)
+    
+    async def _upload_approved(self, doc: Dict, result: Dict) -> Dict[str, str]:
+        """Upload approved document to SharePoint (report and content in parallel)"""
         try:
             workflow_state = result['workflow_state']
             
@@ -199,29 +357,28 @@ class DocumentProcessor:
             improved_content = workflow_state.get('improved_document', {}).get('improved_content', '')
             html_report = workflow_state.get('generated_html', {})
             
-            # Create temp files
-            temp_dir = tempfile.mkdtemp()
-            
-            # HTML file
-            html_path = os.path.join(temp_dir, html_report.get('filename', 'report.html'))
-            with open(html_path, 'w', encoding='utf-8') as f:
-                f.write(html_report.get('content', ''))
-            
-            # Improved content
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            txt_filename = f"KAT_Improved_{Path(doc['filename']).stem}_{timestamp}.txt"
-            txt_path = os.path.join(temp_dir, txt_filename)
-            with open(txt_path, 'w', encoding='utf-8') as f:
-                f.write(improved_content)
-            
-            # Upload
-            html_upload = self.sp_service.upload_file_to_folder(html_path, 'KAT_Processed/Approved/Reports')
-            txt_upload = self.sp_service.upload_file_to_folder(txt_path, 'KAT_Processed/Approved/Content')
-            
-            # Cleanup
-            os.remove(html_path)
-            os.remove(txt_path)
-            os.rmdir(temp_dir)
+            # Create temp files (removed on exit, even if an upload fails)
+            with tempfile.TemporaryDirectory(dir=UPLOAD_STAGING_DIR) as temp_dir:
+                # HTML file - named per document, since a cached workflow result
+                # carries the report filename of the document that produced it
+                html_filename = f"{doc['document_id']}_{html_report.get('filename', 'report.html')}"
+                html_path = os.path.join(temp_dir, html_filename)
+                with open(html_path, 'w', encoding='utf-8') as f:
+                    f.write(html_report.get('content', ''))
+                
+                # Improved content
+                timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+                txt_filename = f"KAT_Improved_{Path(doc['filename']).stem}_{timestamp}.txt"
+                txt_path = os.path.join(temp_dir, txt_filename)
+                with open(txt_path, 'w', encoding='utf-8') as f:
+                    f.write(improved_content)
+                
+                # Upload - the two files are independent, so overlap the round trips;
+                # each upload looks up its client on the thread that runs it
+                html_upload, txt_upload = await asyncio.gather(
+                    asyncio.to_thread(self._upload_file, html_path, 'KAT_Processed/Approved/Reports'),
+                    asyncio.to_thread(self._upload_file, txt_path, 'KAT_Processed/Approved/Content')
+                )
             
             return {
                 'html_url': html_upload.get('sharepoint_url', ''),
@@ -238,69 +395,25 @@ class DocumentProcessor:
             quality_score = result.get('quality_score', 0)
             timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
             
-            report_html = f"""
-<!DOCTYPE html>
-<html>
-<head>
-    <title>Processing Failed - {doc['filename']}</title>
-    <style>
-        body {{ font-family: Arial, sans-serif; margin: 40px; background: #f5f5f5; }}
-        .container {{ background: white; padding: 30px; border-radius: 10px; box-shadow: 0 2px 10px rgba(0,0,0,0.1); }}
-        .header {{ background: linear-gradient(135deg, #ff4444 0%, #cc0000 100%); color: white; padding: 30px; border-radius: 5px; margin: -30px -30px 30px -30px; }}
-        .score {{ font-size: 72px; font-weight: bold; color: #ff4444; text-align: center; margin: 30px 0; }}
-        .threshold {{ font-size: 24px; color: #666; text-align: center; }}
-        .details {{ background: #f9f9f9; padding: 20px; border-radius: 5px; margin: 20px 0; }}
-        .recommendations {{ background: #fff3cd; padding: 20px; border-radius: 5px; border-left: 4px solid #ffc107; }}
-    </style>
-</head>
-<body>
-    <div class="container">
-        <div class="header">
-            <h1>❌ Document Processing Failed</h1>
-            <p>Quality threshold not met</p>
-        </div>
-        
-        <div class="score">{quality_score:.1f}/10</div>
-        <div class="threshold">Threshold Required: {QUALITY_THRESHOLD}/10</div>
-        
-        <div class="details">
-            <h2>Document Details</h2>
-            <p><strong>Filename:</strong> {doc['filename']}</p>
-            <p><strong>User:</strong> {doc['user_email']}</p>
-            <p><strong>Analysis Type:</strong> {doc['analysis_type']}</p>
-            <p><strong>Processed:</strong> {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}</p>
-            <p><strong>Status:</strong> <span style="color: #ff4444; font-weight: bold;">REJECTED</span></p>
-        </div>
-        
-        <div class="recommendations">
-            <h3>💡 Recommendations</h3>
-            <ul>
-                <li>Review document content quality and completeness</li>
-                <li>Check for clarity, structure, and formatting</li>
-                <li>Ensure all required sections are present</li>
-                <li>Verify technical accuracy and consistency</li>
-                <li>Resubmit after making improvements</li>
-            </ul>
-        </div>
-    </div>
-</body>
-</html>
-            """
+            report_html = FAILURE_HTML_TEMPLATE.substitute(
+                filename=html.escape(doc['filename']),
+                user_email=html.escape(doc['user_email']),
+                analysis_type=html.escape(doc['analysis_type']),
+                quality_score=f"{quality_score:.1f}",
+                threshold=QUALITY_THRESHOLD,
+                processed_at=datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            )
             
             # Save to temp file
-            temp_dir = tempfile.mkdtemp()
-            report_filename = f"FAILED_{Path(doc['filename']).stem}_{timestamp}.html"
-            report_path = os.path.join(temp_dir, report_filename)
-            
-            with open(report_path, 'w', encoding='utf-8') as f:
-                f.write(report_html)
-            
-            # Upload
-            upload_result = self.sp_service.upload_file_to_folder(report_path, 'KAT_Processed/Failed')
-            
-            # Cleanup
-            os.remove(report_path)
-            os.rmdir(temp_dir)
+            with tempfile.TemporaryDirectory(dir=UPLOAD_STAGING_DIR) as temp_dir:
+                report_filename = f"FAILED_{Path(doc['filename']).stem}_{timestamp}.html"
+                report_path = os.path.join(temp_dir, report_filename)
+                
+                with open(report_path, 'w', encoding='utf-8') as f:
+                    f.write(report_html)
+                
+                # Upload
+                upload_result = self._upload_file(report_path, 'KAT_Processed/Failed')
             
             return upload_result.get('sharepoint_url', '')
             
@@ -1,12 +1,16 @@
 #!/usr/bin/env python3
 """
 KAT Document Processor Watcher
-- Watches database every 30 seconds
+- Wakes within a second of any commit to the database
+- Full reconciliation check every 5 minutes
 - Processes MAX 2 documents in parallel  
-- Prevents overlap with file lock
+- Prevents overlap with an exclusive flock
 - Graceful shutdown
+- Runs on one asyncio event loop; processing cycles run in a worker thread
 """
 
+import asyncio
+import fcntl
 import time
 import logging
 import os
@@ -20,89 +24,83 @@ from database import DocumentDatabase
 
 # Configuration
 LOCK_FILE = Path("/tmp/kat_watcher.lock")
-CHECK_INTERVAL = 30  # seconds
+CHECK_INTERVAL = 1  # seconds between (cheap) change checks
+RECONCILE_INTERVAL = 300  # seconds between stats checks when nothing changed
+ERROR_BACKOFF = 30  # seconds to wait after a watch loop error
 MAX_CONCURRENT = 2    # Max parallel documents
 
-# Setup logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('watcher.log'),
-        logging.StreamHandler()
-    ]
-)
+# Logging is configured by the processor module (queue-backed handlers)
 logger = logging.getLogger(__name__)
 
 # Global state
 db = DocumentDatabase()
 processor = DocumentProcessor()
-shutdown_flag = False
 
-def signal_handler(signum, frame):
-    """Graceful shutdown on Ctrl+C"""
-    global shutdown_flag
+def request_shutdown(shutdown: asyncio.Event):
+    """Graceful shutdown on Ctrl+C / SIGTERM"""
     logger.info("🛑 Shutdown signal received, cleaning up...")
-    shutdown_flag = True
+    shutdown.set()
 
-# Register signal handlers
-signal.signal(signal.SIGINT, signal_handler)
-signal.signal(signal.SIGTERM, signal_handler)
-
-def is_already_running() -> bool:
-    """Check if watcher is already running using file lock"""
-    if LOCK_FILE.exists():
-        try:
-            pid = int(LOCK_FILE.read_text().strip())
-            os.kill(pid, 0)  # Check if process exists
-            logger.error(f"❌ Watcher already running (PID: {pid}). Exiting.")
-            return True
-        except (OSError, ValueError):
-            logger.warning("🔓 Found stale lock, removing...")
-            LOCK_FILE.unlink()
-    return False
-
-def acquire_lock() -> bool:
-    """Acquire exclusive lock for this watcher instance"""
-    try:
-        LOCK_FILE.write_text(str(os.getpid()))
-        logger.info(f"🔒 Lock acquired (PID: {os.getpid()})")
-        return True
-    except Exception as e:
-        logger.error(f"❌ Failed to acquire lock: {e}")
-        return False
-
-def release_lock():
-    """Release lock file"""
+async def wait_or_shutdown(shutdown: asyncio.Event, seconds: float):
+    """Sleep up to `seconds`, returning early if shutdown was requested"""
     try:
-        if LOCK_FILE.exists():
-            LOCK_FILE.unlink()
-            logger.info("🔓 Lock released")
-    except Exception as e:
-        logger.warning(f"⚠️ Lock cleanup failed: {e}")
+        await asyncio.wait_for(shutdown.wait(), seconds)
+    except asyncio.TimeoutError:
+        pass
 
-def watch_database():
+async def watch_database():
     """Main watcher loop"""
-    global shutdown_flag
-    
-    # 1. CHECK FOR OVERLAP
-    if is_already_running():
+    # 1. CHECK FOR OVERLAP - the lock is held for the life of the process
+    # and the kernel drops it however we exit, so it can never go stale
+    lock_fd = os.open(LOCK_FILE, os.O_CREAT | os.O_RDWR, 0o644)
+    try:
+        fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        logger.error(f"❌ Watcher already running (lock held on {LOCK_FILE}). Exiting.")
         sys.exit(1)
     
-    if not acquire_lock():
-        sys.exit(1)
+    os.ftruncate(lock_fd, 0)
+    os.write(lock_fd, str(os.getpid()).encode())
+    logger.info(f"🔒 Lock acquired (PID: {os.getpid()})")
     
-    try:
-        logger.info("🚀 Starting KAT Document Watcher")
-        logger.info(f"📊 Config: Check every {CHECK_INTERVAL}s, Max {MAX_CONCURRENT} parallel docs")
-        
-        last_queued_count = 0
-        consecutive_no_work = 0
-        
-        while not shutdown_flag:
-            try:
-                # 2. CHECK DATABASE FOR PENDING WORK
-                stats = db.get_processing_stats()
+    # Register signal handlers on the event loop
+    shutdown = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, request_shutdown, shutdown)
+    
+    logger.info("🚀 Starting KAT Document Watcher")
+    logger.info(
+        f"📊 Config: Change check every {CHECK_INTERVAL}s, reconcile every {RECONCILE_INTERVAL}s, "
+        f"Max {MAX_CONCURRENT} parallel docs"
+    )
+    
+    last_queued_count = 0
+    consecutive_no_work = 0
+    last_data_version = None
+    last_stats_at = 0.0
+    
+    while not shutdown.is_set():
+        try:
+            # 2. WAKE ONLY WHEN SOMETHING WAS COMMITTED (or to reconcile)
+            # PRAGMA data_version changes on any commit by another
+            # connection - the frontend's uploads included - without
+            # reading a single table page
+            data_version = db.data_version()
+            if (data_version == last_data_version
+                    and time.monotonic() - last_stats_at < RECONCILE_INTERVAL):
+                await wait_or_shutdown(shutdown, CHECK_INTERVAL)
+                continue
+            last_data_version = data_version
+            last_stats_at = time.monotonic()
+            
+            # CHECK DATABASE FOR PENDING WORK - an EXISTS probe; per-status
+            # counts are only gathered when there is work to report
+            if not db.has_queued_documents():
+                consecutive_no_work += 1
+                last_queued_count = 0
+            else:
+                stats = db.get_processing_stats(ttl_ms=0)
                 queued_count = stats['queued']
                 
                 logger.info(
@@ -112,41 +110,34 @@ def watch_database():
                 )
                 
                 # 3. PROCESS IF NEW WORK FOUND
-                if queued_count > 0:
-                    if queued_count != last_queued_count:
-                        logger.info(f"📋 New work detected ({queued_count} queued) - processing...")
-                        
-                        # 4. RUN PROCESSOR (MAX 2 PARALLEL DOCS)
-                        processor.run()  # ← Uses ThreadPoolExecutor(max_workers=2)
-                        
-                        consecutive_no_work = 0
-                        last_queued_count = 0  # Reset
-                    else:
-                        logger.debug("⏳ No new work, but queue exists")
-                        consecutive_no_work += 1
+                if queued_count != last_queued_count:
+                    logger.info(f"📋 New work detected ({queued_count} queued) - processing...")
+                    
+                    # 4. RUN PROCESSOR (MAX 2 PARALLEL DOCS)
+                    # Blocking cycle runs off the loop, so signals are still handled
+                    await asyncio.to_thread(processor.run)  # ← Uses ThreadPoolExecutor(max_workers=2)
+                    
+                    consecutive_no_work = 0
+                    last_queued_count = 0  # Reset
                 else:
+                    logger.debug("⏳ No new work, but queue exists")
                     consecutive_no_work += 1
-                    last_queued_count = 0
-                
-                # 5. IDLE LOGGING
-                if consecutive_no_work % 10 == 0:  # Every 5 minutes
-                    logger.info(f"😴 Idle for {consecutive_no_work * CHECK_INTERVAL}s - watching...")
-                
-                # 6. SLEEP
-                for i in range(CHECK_INTERVAL):
-                    if shutdown_flag:
-                        break
-                    time.sleep(1)
-                
-            except Exception as e:
-                logger.error(f"❌ Watch loop error: {e}")
-                time.sleep(CHECK_INTERVAL)
-        
-        logger.info("✅ Watcher stopped gracefully")
-        
-    finally:
-        # 7. ALWAYS CLEANUP LOCK
-        release_lock()
+            
+            # 5. IDLE LOGGING
+            if consecutive_no_work and consecutive_no_work % 10 == 0:
+                logger.info(f"😴 No work on the last {consecutive_no_work} checks - watching...")
+            
+            # 6. SLEEP (returns at once on shutdown)
+            await wait_or_shutdown(shutdown, CHECK_INTERVAL)
+            
+        except Exception as e:
+            logger.error(f"❌ Watch loop error: {e}")
+            # Forget the version so the check is retried after the backoff,
+            # not skipped until the next reconcile
+            last_data_version = None
+            await wait_or_shutdown(shutdown, ERROR_BACKOFF)
+    
+    logger.info("✅ Watcher stopped gracefully")
 
 if __name__ == "__main__":
-    watch_database()
+    asyncio.run(watch_database())